@@ -1,8 +1,15 @@
 import os
+import re
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, wait
+import numpy as np
 import pandas as pd
 import streamlit as st
-import plotly.express as px
+import plotly.graph_objects as go
 from pyathena import connect
+from pyathena.pandas.cursor import PandasCursor
+from streamlit.runtime.scriptrunner import add_script_run_ctx, get_script_run_ctx
 
 st.set_page_config(page_title="US Education Dashboard", layout="wide")
 st.title("US Education Dashboard")
@@ -22,7 +29,32 @@ RESULTS_S3 = st.secrets.get(
     os.getenv("ATHENA_OUTPUT", "s3://us-education-pipeline-2025/athena-results/")
 )
 
-# Prefer the view you created earlier. If you didn't create it, we'll fallback.
+# Result reuse needs an Athena engine v3 workgroup; set ATHENA_RESULT_REUSE=false for older engines.
+WORKGROUP = st.secrets.get(
+    "ATHENA_WORKGROUP",
+    os.getenv("ATHENA_WORKGROUP", "primary")
+)
+
+RESULT_REUSE = str(st.secrets.get(
+    "ATHENA_RESULT_REUSE",
+    os.getenv("ATHENA_RESULT_REUSE", "true")
+)).strip().lower()
+if RESULT_REUSE not in ("1", "true", "yes", "0", "false", "no"):
+    st.error(f"Invalid ATHENA_RESULT_REUSE value: {RESULT_REUSE!r} (expected true/false)")
+    st.stop()
+
+# Optional overrides so cold starts can skip the information_schema probes.
+SOURCE_OVERRIDE = st.secrets.get(
+    "US_EDU_SOURCE",
+    os.getenv("US_EDU_SOURCE")
+)
+
+HAS_NATIONAL_OVERRIDE = st.secrets.get(
+    "US_EDU_HAS_NATIONAL",
+    os.getenv("US_EDU_HAS_NATIONAL")
+)
+
+# Prefer the metrics view (or its materialized table, see README). If it's missing, we'll fallback.
 PREFERRED_SOURCE = "v_state_year_metrics"
 FALLBACK_SOURCE = "states_all"
 
@@ -40,33 +72,95 @@ STATE_TO_CODE = {
     "Washington":"WA","West Virginia":"WV","Wisconsin":"WI","Wyoming":"WY"
 }
 
+STATE_TO_CODE_UPPER = {k.upper(): v for k, v in STATE_TO_CODE.items()}
+
+# Athena-side state -> 2-letter code mapping ("NEW_YORK", "New  York", "ny" -> "NY"); NULL if unknown.
+# Any 2-letter alphabetic value is kept as a code; names have underscores/whitespace runs collapsed first.
+STATE_CASE_SQL = (
+    r"CASE WHEN regexp_like(trim(state), '^\p{L}{2}$') THEN upper(trim(state)) "
+    r"ELSE CASE upper(trim(regexp_replace(state, '[_\s]+', ' '))) "
+    + " ".join(f"WHEN '{name}' THEN '{code}'" for name, code in STATE_TO_CODE_UPPER.items())
+    + " END END"
+)
+
+# One Connection (and boto3 client) per process; athena_df opens a fresh cursor per query,
+# so sharing it across reruns and worker threads is safe.
+@st.cache_resource
 def get_conn():
     return connect(
         s3_staging_dir=RESULTS_S3,
         region_name=REGION,
-        schema_name=DB
+        schema_name=DB,
+        work_group=WORKGROUP,
+        # Let Athena serve identical queries from its result cache instead of rescanning S3.
+        result_reuse_enable=RESULT_REUSE in ("1", "true", "yes"),
+        result_reuse_minutes=60,
+        # Load results straight from the S3 CSV with pandas' C parser instead of row-by-row fetches.
+        cursor_class=PandasCursor,
     )
 
-@st.cache_data(ttl=900)
-def athena_df(sql: str) -> pd.DataFrame:
-    return pd.read_sql(sql, get_conn())
+def submit(pool: ThreadPoolExecutor, fn, *args):
+    # Attach the calling script's context to the worker thread; otherwise st.cache_data
+    # warns about a missing ScriptRunContext and drops its spinner.
+    ctx = get_script_run_ctx()
+
+    def run():
+        add_script_run_ctx(threading.current_thread(), ctx)
+        return fn(*args)
 
+    return pool.submit(run)
+
+@st.cache_data(ttl=900)
+def athena_df(sql: str, params: dict | None = None) -> pd.DataFrame:
+    # Values go in as pyformat parameters (%(name)s) so each query type keeps one canonical SQL text
+    with get_conn().cursor() as cursor:
+        df = cursor.execute(sql, params).as_pandas()
+    # Arrow-backed strings use less memory than object columns and get vectorized .str kernels.
+    # Only convert object columns that really hold strings: pandas 3 already returns varchar as
+    # Arrow-backed str, and decimal columns come back as Decimal objects that must stay numeric.
+    str_cols = [
+        c for c in df.columns
+        if df[c].dtype == object and pd.api.types.infer_dtype(df[c], skipna=True) == "string"
+    ]
+    return df.astype({c: "string[pyarrow]" for c in str_cols}) if str_cols else df
+
+# Table detection stays in memory; set US_EDU_SOURCE / US_EDU_HAS_NATIONAL to skip it on cold starts
 @st.cache_data(ttl=3600)
-def pick_source() -> str:
-    q = f"""
+def pick_source(db: str) -> str:
+    q = """
     SELECT table_name
     FROM information_schema.tables
-    WHERE table_schema = '{DB}'
+    WHERE table_schema = %(db)s
     """
-    tables = set(athena_df(q)["table_name"].str.lower())
+    tables = set(athena_df(q, {"db": db})["table_name"].str.lower())
     return PREFERRED_SOURCE if PREFERRED_SOURCE.lower() in tables else FALLBACK_SOURCE
 
-SOURCE = pick_source()
+SOURCE = SOURCE_OVERRIDE or pick_source(DB)
 
-@st.cache_data(ttl=3600)
-def get_states():
-    q_states = f"SELECT DISTINCT state FROM {SOURCE} ORDER BY state"
-    return athena_df(q_states)["state"].dropna().tolist()
+# SOURCE is spliced into SQL as a table name, so only accept a plain identifier
+if not re.fullmatch(r"[A-Za-z_][A-Za-z0-9_]*", SOURCE):
+    st.error(f"Invalid source table name: {SOURCE!r}")
+    st.stop()
+
+# Years and states barely change, so keep them on disk across restarts.
+# Disk-persisted caches ignore ttl, so each result carries its fetch time and
+# daily() clears the function's cache (memory and disk) once that is a day old.
+@st.cache_data(persist="disk")
+def get_states(source: str):
+    q_states = f"SELECT DISTINCT state FROM {source} ORDER BY state"
+    return time.time(), athena_df(q_states)["state"].dropna().tolist()
+
+@st.cache_data(persist="disk")
+def get_year_range(years_sql: str):
+    years = athena_df(years_sql)["year"].astype(int).tolist()
+    return time.time(), (min(years), max(years))
+
+def daily(fn, *args):
+    fetched_at, value = fn(*args)
+    if time.time() - fetched_at > 86400:
+        fn.clear()
+        fetched_at, value = fn(*args)
+    return value
 
 
 # metric mapping depends on whether we have the view
@@ -78,7 +172,7 @@ if SOURCE == PREFERRED_SOURCE:
         "Total Expenditure": "total_expenditure",
         "Total Revenue": "total_revenue",
     }
-    years_sql = f"SELECT DISTINCT year FROM {SOURCE} ORDER BY year"
+    source_rel = SOURCE
 else:
     # fallback: compute metrics on the fly (works, but slower / less “clean”)
     metric_options = {
@@ -88,10 +182,15 @@ else:
         "Total Expenditure": "total_expenditure",
         "Total Revenue": "total_revenue",
     }
-    years_sql = f"SELECT DISTINCT CAST(year AS integer) AS year FROM {SOURCE} ORDER BY year"
+    # Cast year once here so every query below filters and groups on a plain integer column
+    source_rel = f"""(
+        SELECT state, CAST(year AS integer) AS year, enroll, total_revenue, total_expenditure
+        FROM {SOURCE}
+    ) AS s"""
 
-years = athena_df(years_sql)["year"].astype(int).tolist()
-min_year, max_year = min(years), max(years)
+years_sql = f"SELECT DISTINCT year FROM {source_rel} ORDER BY year"
+
+min_year, max_year = daily(get_year_range, years_sql)
 
 c1, c2, c3 = st.columns([2, 3, 2])
 with c1:
@@ -103,190 +202,199 @@ with c3:
 
 metric_expr = metric_options[metric_label]
 
-# Pull data for selected year
-if SOURCE == PREFERRED_SOURCE:
-    q = f"""
-    SELECT state, year, {metric_expr} AS metric, enroll, total_revenue, total_expenditure
-    FROM {SOURCE}
-    WHERE year = {year}
-    """
-else:
-    q = f"""
-    SELECT state,
-           CAST(year AS integer) AS year,
-           {metric_expr} AS metric,
-           enroll, total_revenue, total_expenditure
-    FROM {SOURCE}
-    WHERE CAST(year AS integer) = {year}
-    """
-
-df = athena_df(q)
-def to_state_code(s: str):
-    if s is None:
-        return None
-
-    s = str(s).strip()
-
-    # If already a 2-letter code, keep it
-    if len(s) == 2 and s.isalpha():
-        return s.upper()
-
-    # Normalize: underscores -> spaces, collapse whitespace, and standardize case
-    s_norm = s.replace("_", " ").strip()
-    s_norm = " ".join(s_norm.split())  # collapse multiple spaces
-
-    # Try title-case match: "new mexico" -> "New Mexico"
-    s_title = s_norm.title()
-    if s_title in STATE_TO_CODE:
-        return STATE_TO_CODE[s_title]
-
-    # Try uppercase match
-    upper_map = {k.upper(): v for k, v in STATE_TO_CODE.items()}
-    s_upper = s_norm.upper()
-    return upper_map.get(s_upper)
-
-
-df["state_code"] = df["state"].apply(to_state_code)
-
-# DEBUG: show mapping success rate
-# st.caption(f"Rows from Athena: {len(df)} | Mapped state codes: {df['state_code'].notna().sum()}")
-
-# Only drop after we’ve shown debug info
-df = df.dropna(subset=["state_code"])
-
-
-# KPI cards
-k1, k2, k3, k4 = st.columns(4)
-k1.metric("States in view", f"{df['state'].nunique()}")
-k2.metric("Avg metric", f"{df['metric'].mean():,.2f}" if df["metric"].notna().any() else "—")
-k3.metric("Max metric", f"{df['metric'].max():,.2f}" if df["metric"].notna().any() else "—")
-k4.metric("Min metric", f"{df['metric'].min():,.2f}" if df["metric"].notna().any() else "—")
-
-left, right = st.columns([2.2, 1])
-
-with left:
-    fig = px.choropleth(
-        df,
-        locations="state_code",
-        locationmode="USA-states",
-        color="metric",
-        scope="usa",
-        hover_name="state",
-        hover_data={"state_code": False, "metric": True, "enroll": True, "total_revenue": True, "total_expenditure": True},
-        labels={"metric": metric_label},
-    )
-    fig.update_layout(margin=dict(l=0, r=0, t=0, b=0))
-    st.plotly_chart(fig, use_container_width=True)
-
-with right:
-    st.subheader(f"{metric_label} — {year}")
-    top = df.sort_values("metric", ascending=False).head(10)[["state", "metric"]]
-    bottom = df.sort_values("metric", ascending=True).head(10)[["state", "metric"]]
-    st.write("Top 10")
-    st.dataframe(top, use_container_width=True, height=240)
-    st.write("Bottom 10")
-    st.dataframe(bottom, use_container_width=True, height=240)
-
-states_list = get_states()
+# Extra columns shown in the map hover; skip the one the metric already is (e.g. Total Revenue)
+hover_cols = [c for c in ["enroll", "total_revenue", "total_expenditure"] if c != metric_expr]
+
+# Pull data for selected year; rows that do not map to a state code are dropped in Athena
+q = f"""
+SELECT *
+FROM (
+    SELECT state, {STATE_CASE_SQL} AS state_code,
+           {metric_expr} AS metric, {", ".join(hover_cols)}
+    FROM {source_rel}
+    WHERE year = %(year)s
+)
+WHERE state_code IS NOT NULL
+"""
+
+# KPIs are aggregated by Athena over the same slice, so only four scalars come back
+kpi_q = f"""
+SELECT COUNT(DISTINCT state) AS states,
+       AVG(metric) AS avg_metric,
+       MAX(metric) AS max_metric,
+       MIN(metric) AS min_metric
+FROM ({q})
+"""
+
+# The map/KPI section is filled in once the drill-down state is known,
+# so the slice and both trends can be queried at the same time.
+overview = st.container()
+
+states_list = daily(get_states, SOURCE)
 selected_state = st.selectbox("Drill into a state", states_list, index=states_list.index("NEW_YORK") if "NEW_YORK" in states_list else 0)
 
 st.divider()
 st.subheader(f"Trend: {selected_state.replace('_',' ').title()} vs National")
 
-# Use view columns if available
-if SOURCE == PREFERRED_SOURCE:
-    state_trend_q = f"""
+# Trend SQL depends on neither the year nor the slice, so athena_df's (sql, params) cache
+# already serves these across year-slider moves; the helpers just build the SQL.
+def fetch_state_trend(state: str, metric_expr: str, source_rel: str) -> pd.DataFrame:
+    q = f"""
     SELECT year, {metric_expr} AS metric
-    FROM {SOURCE}
-    WHERE state = '{selected_state}'
+    FROM {source_rel}
+    WHERE state = %(state)s
     ORDER BY year
     """
-else:
-    state_trend_q = f"""
-    SELECT CAST(year AS integer) AS year, {metric_expr} AS metric
-    FROM {SOURCE}
-    WHERE state = '{selected_state}'
-    ORDER BY CAST(year AS integer)
-    """
+    return athena_df(q, {"state": state})
 
 # National line (always use v_national_summary if it exists)
 # We'll detect it and fallback if needed.
 @st.cache_data(ttl=3600)
-def has_table_or_view(name: str) -> bool:
-    q = f"""
+def has_table_or_view(db: str, name: str) -> bool:
+    q = """
     SELECT table_name
     FROM information_schema.tables
-    WHERE table_schema = '{DB}'
-      AND lower(table_name) = lower('{name}')
-    """
-    return len(athena_df(q)) > 0
-
-use_national = has_table_or_view("v_national_summary")
-
-if use_national:
-    # national spend per student exists in the view, but for other metrics we approximate:
-    # - revenue per student: national_revenue/national_enrollment
-    # - surplus_deficit: national_revenue - national_expenditure (total, not per student)
-    # We'll compute a "national metric" that matches the selected metric label as best as possible.
-    if metric_label == "Expenditure per student":
-        nat_expr = "national_spend_per_student"
-    elif metric_label == "Revenue per student":
-        nat_expr = "national_revenue / NULLIF(national_enrollment, 0)"
-    elif metric_label == "Surplus / Deficit":
-        nat_expr = "national_revenue - national_expenditure"
-    elif metric_label == "Total Expenditure":
-        nat_expr = "national_expenditure"
-    elif metric_label == "Total Revenue":
-        nat_expr = "national_revenue"
-    else:
-        nat_expr = "national_spend_per_student"
-
-    national_q = f"""
-    SELECT year, {nat_expr} AS metric
-    FROM v_national_summary
-    ORDER BY year
+    WHERE table_schema = %(db)s
+      AND lower(table_name) = lower(%(name)s)
     """
+    return len(athena_df(q, {"db": db, "name": name})) > 0
+
+if HAS_NATIONAL_OVERRIDE is not None:
+    flag = str(HAS_NATIONAL_OVERRIDE).strip().lower()
+    if flag not in ("1", "true", "yes", "0", "false", "no"):
+        st.error(f"Invalid US_EDU_HAS_NATIONAL value: {HAS_NATIONAL_OVERRIDE!r} (expected true/false)")
+        st.stop()
+    use_national = flag in ("1", "true", "yes")
 else:
-    # fallback: compute national aggregate from SOURCE directly
-    if SOURCE == PREFERRED_SOURCE:
-        national_q = f"""
-        SELECT
-          year,
-          AVG({metric_expr}) AS metric
-        FROM {SOURCE}
-        GROUP BY year
+    use_national = has_table_or_view(DB, "v_national_summary")
+
+def fetch_national_trend(metric_label: str, metric_expr: str, source_rel: str, use_national: bool) -> pd.DataFrame:
+    if use_national:
+        # national spend per student exists in the view, but for other metrics we approximate:
+        # - revenue per student: national_revenue/national_enrollment
+        # - surplus_deficit: national_revenue - national_expenditure (total, not per student)
+        # We'll compute a "national metric" that matches the selected metric label as best as possible.
+        if metric_label == "Expenditure per student":
+            nat_expr = "national_spend_per_student"
+        elif metric_label == "Revenue per student":
+            nat_expr = "national_revenue / NULLIF(national_enrollment, 0)"
+        elif metric_label == "Surplus / Deficit":
+            nat_expr = "national_revenue - national_expenditure"
+        elif metric_label == "Total Expenditure":
+            nat_expr = "national_expenditure"
+        elif metric_label == "Total Revenue":
+            nat_expr = "national_revenue"
+        else:
+            nat_expr = "national_spend_per_student"
+
+        q = f"""
+        SELECT year, {nat_expr} AS metric
+        FROM v_national_summary
         ORDER BY year
         """
     else:
-        national_q = f"""
+        # fallback: compute national aggregate from SOURCE directly
+        q = f"""
         SELECT
-          CAST(year AS integer) AS year,
+          year,
           AVG({metric_expr}) AS metric
-        FROM {SOURCE}
-        GROUP BY CAST(year AS integer)
-        ORDER BY CAST(year AS integer)
+        FROM {source_rel}
+        GROUP BY year
+        ORDER BY year
         """
-
-state_trend = athena_df(state_trend_q)
-national_trend = athena_df(national_q)
-
-state_trend["series"] = selected_state.replace("_"," ").title()
-national_trend["series"] = "National"
-
-trend = pd.concat([state_trend, national_trend], ignore_index=True)
-trend = trend.dropna(subset=["year", "metric"])
-trend["year"] = trend["year"].astype(int)
-
-fig2 = px.line(
-    trend,
-    x="year",
-    y="metric",
-    color="series",
-    markers=True,
-    labels={"metric": metric_label, "year": "Year", "series": ""},
+    return athena_df(q)
+
+# The queries are independent, so run them side by side: latency is the slowest one, not the sum.
+# Cache hits return immediately; only the misses go to Athena. The pool is per rerun rather than
+# shared, so concurrent sessions never queue behind each other's Athena queries.
+with ThreadPoolExecutor(max_workers=4) as pool:
+    futures = {
+        "slice": submit(pool, athena_df, q, {"year": year}),
+        "kpi": submit(pool, athena_df, kpi_q, {"year": year}),
+        "state": submit(pool, fetch_state_trend, selected_state, metric_expr, source_rel),
+        "national": submit(pool, fetch_national_trend, metric_label, metric_expr, source_rel, use_national),
+    }
+    wait(futures.values())
+
+df = futures["slice"].result()
+# The metric may arrive as nullable Int64 or Decimal objects; plotly and nlargest need plain floats
+df["metric"] = df["metric"].to_numpy(dtype=float, na_value=np.nan)
+kpi = futures["kpi"].result().iloc[0]
+state_trend = futures["state"].result()
+national_trend = futures["national"].result()
+
+with overview:
+    # KPI cards
+    k1, k2, k3, k4 = st.columns(4)
+    k1.metric("States in view", f"{int(kpi['states'])}")
+    k2.metric("Avg metric", f"{kpi['avg_metric']:,.2f}" if pd.notna(kpi["avg_metric"]) else "—")
+    k3.metric("Max metric", f"{kpi['max_metric']:,.2f}" if pd.notna(kpi["max_metric"]) else "—")
+    k4.metric("Min metric", f"{kpi['min_metric']:,.2f}" if pd.notna(kpi["min_metric"]) else "—")
+
+    left, right = st.columns([2.2, 1])
+
+    with left:
+        # Build the trace directly from arrays; px would re-derive all of this from the DataFrame
+        fig = go.Figure(go.Choropleth(
+            locations=df["state_code"].to_numpy(),
+            z=df["metric"].to_numpy(),
+            locationmode="USA-states",
+            text=df["state"].to_numpy(),
+            customdata=df[hover_cols].to_numpy(dtype=float, na_value=np.nan),
+            hovertemplate=(
+                f"<b>%{{text}}</b><br>{metric_label}=%{{z}}"
+                + "".join(f"<br>{c}=%{{customdata[{i}]}}" for i, c in enumerate(hover_cols))
+                + "<extra></extra>"
+            ),
+            colorbar=dict(title=metric_label),
+        ))
+        fig.update_layout(geo=dict(scope="usa"), margin=dict(l=0, r=0, t=0, b=0))
+        st.plotly_chart(fig, use_container_width=True)
+
+    with right:
+        st.subheader(f"{metric_label} — {year}")
+        slim = df[["state", "metric"]]
+        top = slim.nlargest(10, "metric")
+        bottom = slim.nsmallest(10, "metric")
+        st.write("Top 10")
+        st.dataframe(top, use_container_width=True, height=240)
+        st.write("Bottom 10")
+        st.dataframe(bottom, use_container_width=True, height=240)
+
+# Build the combined trend frame straight from arrays instead of concat + dropna + astype copies
+trend_years = np.concatenate([
+    state_trend["year"].to_numpy(dtype=float, na_value=np.nan),
+    national_trend["year"].to_numpy(dtype=float, na_value=np.nan),
+])
+trend_metrics = np.concatenate([
+    state_trend["metric"].to_numpy(dtype=float, na_value=np.nan),
+    national_trend["metric"].to_numpy(dtype=float, na_value=np.nan),
+])
+trend_series = np.repeat([selected_state.replace("_"," ").title(), "National"], [len(state_trend), len(national_trend)])
+keep = ~(np.isnan(trend_years) | np.isnan(trend_metrics))
+
+trend = pd.DataFrame({
+    "year": trend_years[keep].astype(int),
+    "metric": trend_metrics[keep],
+    "series": trend_series[keep],
+})
+
+fig2 = go.Figure()
+for name in pd.unique(trend["series"]):
+    part = trend[trend["series"] == name]
+    fig2.add_trace(go.Scatter(
+        x=part["year"].to_numpy(),
+        y=part["metric"].to_numpy(),
+        mode="lines+markers",
+        name=name,
+        hovertemplate=f"{name}<br>Year=%{{x}}<br>{metric_label}=%{{y}}<extra></extra>",
+    ))
+
+fig2.update_layout(
+    xaxis_title="Year",
+    yaxis_title=metric_label,
+    margin=dict(l=0, r=0, t=10, b=0),
 )
-
-fig2.update_layout(margin=dict(l=0, r=0, t=10, b=0))
 st.plotly_chart(fig2, use_container_width=True)
 
 # KPI delta for selected year